@@ -5,12 +5,17 @@ This plugin processes images according to their class attributes.
 
 import codecs
 import collections
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
 import contextlib
 import copy
 import functools
+import hashlib
 import html
+import itertools
+import json
 import logging
 import os.path
+import pickle
 import posixpath
 import pprint
 import re
@@ -21,7 +26,8 @@ from urllib.parse import unquote, urlparse
 from urllib.request import pathname2url, url2pathname
 
 from bs4 import BeautifulSoup
-from PIL import Image, ImageFilter, UnidentifiedImageError
+import PIL
+from PIL import Image, ImageFilter, UnidentifiedImageError, features
 
 from pelican import __version__ as pelican_version, signals
 
@@ -29,9 +35,23 @@ logger = logging.getLogger(__name__)
 
 LOG_PREFIX = "[image_process]"
 
+# Images to process have a class made of this prefix and the derivative name.
+IMAGE_PROCESS_PREFIX = "image-process-"
+# Former way of matching these classes, kept for code importing it.
 IMAGE_PROCESS_REGEX = re.compile("image-process-[-a-zA-Z0-9_]+")
 
+# Tags that some parsers add around fragments to make them a full document.
+DOCUMENT_TAGS = ("html", "head", "body")
+# Matches documents starting with one of these tags, possibly after a
+# doctype, XML declaration or comments, rather than tags found anywhere
+# (e.g. in a script).
+DOCUMENT_TAGS_REGEX = re.compile(
+    r"\s*(?:(?:<!--.*?-->|<![^>]*>|<\?[^>]*>)\s*)*<(?:html|head|body)[\s/>]",
+    re.IGNORECASE | re.DOTALL,
+)
+
 Path = collections.namedtuple("Path", ["base_url", "source", "base_path", "filename"])
+Operation = collections.namedtuple("Operation", ["name", "function", "args"])
 
 
 # A lot of inspiration from pyexiftool (https://github.com/smarnach/pyexiftool)
@@ -40,7 +60,11 @@ class ExifTool:
 
     errors = "strict"
     sentinel = b"{ready}"
-    block_size = 4096
+    block_size = 65536
+    # Commands are sent to exiftool in batches rather than waiting for each
+    # of them in turn. Batches stay small enough for the commands and their
+    # output to fit in the pipe buffers.
+    batch_size = 64
 
     _instance = None
 
@@ -64,16 +88,25 @@ class ExifTool:
 
     @staticmethod
     def stop_exiftool():
-        """Tear down ExifTool instance."""
+        """Copy the pending EXIF tags and tear down ExifTool instance."""
+        if ExifTool._instance is not None:
+            ExifTool._instance._send_pending_commands()
         ExifTool._instance = None
 
     def __init__(self):
-        """Invoke exiftool via subprocess call."""
+        """Prepare to invoke exiftool, once there are tags to copy."""
         self.encoding = sys.getfilesystemencoding()
         if self.encoding != "mbcs":
             with contextlib.suppress(LookupError):
                 codecs.lookup_error("surrogateescape")
 
+        # Batches of up-to-date images have no tags to copy: exiftool is only
+        # started when the first commands are sent.
+        self.process = None
+        self.pending = []
+
+    def _start_process(self):
+        """Invoke exiftool via subprocess call."""
         with open(os.devnull, "w") as devnull:
             self.process = subprocess.Popen(
                 [
@@ -101,86 +134,229 @@ class ExifTool:
             b"-TagsFromFile",
             src.encode(self.encoding, ExifTool.errors),
             b'"-all:all>all:all"',
+            # Overwrite the derivative in place rather than keeping a backup
+            # to delete with a second command.
+            b"-overwrite_original",
             dst.encode(self.encoding, ExifTool.errors),
         )
-        self._send_command(params)
-        params = (b"-delete_original!", dst.encode(self.encoding, ExifTool.errors))
-        self._send_command(params)
-
-    def _send_command(self, params):
-        self.process.stdin.write(b"\n".join((*params, b"-j\n", b"-execute\n")))
+        self.pending.append(params)
+        if len(self.pending) >= ExifTool.batch_size:
+            self._send_pending_commands()
+
+    def _send_pending_commands(self):
+        commands, self.pending = self.pending, []
+        if not commands:
+            return
+        if self.process is None:
+            self._start_process()
+
+        self.process.stdin.write(
+            b"".join(
+                b"\n".join((*params, b"-j\n", b"-execute\n")) for params in commands
+            )
+        )
         self.process.stdin.flush()
         output = b""
         fd = self.process.stdout.fileno()
-        while not output.strip().endswith(ExifTool.sentinel):
-            output += os.read(fd, ExifTool.block_size)
-        exiftool_result = output.strip()[: -len(ExifTool.sentinel)]
-        logger.debug(
-            "{} exiftool result: {}".format(LOG_PREFIX, exiftool_result.decode("utf-8"))
-        )
+        while output.count(ExifTool.sentinel) < len(commands):
+            data = os.read(fd, ExifTool.block_size)
+            if not data:
+                break
+            output += data
+        for exiftool_result in output.split(ExifTool.sentinel)[: len(commands)]:
+            logger.debug(
+                "{} exiftool result: {}".format(
+                    LOG_PREFIX, exiftool_result.strip().decode("utf-8")
+                )
+            )
+
+
+class Manifest:
+    """Record of the derivative images generated by previous builds.
+
+    A derivative is up to date when its source image has the same content,
+    and its operations and output settings are the same as when it was
+    generated, whatever the modification times of the files (which git or
+    rsync may change).
+    """
+
+    def __init__(self, path):
+        """Load the manifest at path, if it exists."""
+        self.path = path
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        # Source path -> [size, modification time, content hash]
+        self.sources = data.get("sources", {})
+        # Derivative path -> [source content hash, operations, settings hash]
+        self.derivatives = data.get("derivatives", {})
+        self.changed = False
+
+    def _source_hash(self, path):
+        # Sources are only hashed again when their size or modification time
+        # changed.
+        stat = os.stat(path)
+        entry = self.sources.get(path)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+
+        with open(path, "rb") as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        self.sources[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        self.changed = True
+        return digest
+
+    def _entry(self, image, settings):
+        # Custom operations are recorded by their representation, which
+        # usually changes between builds: their derivatives are regenerated.
+        operations = [op if isinstance(op, str) else repr(op) for op in image[2]]
+        # The settings changing how the derivative is resampled and encoded.
+        output_settings = [
+            get_save_options(settings, image[1]),
+            settings["IMAGE_PROCESS_RESAMPLE"],
+            settings["IMAGE_PROCESS_REDUCING_GAP"],
+            settings["IMAGE_PROCESS_DRAFT"],
+        ]
+        settings_hash = hashlib.blake2b(
+            json.dumps(output_settings, sort_keys=True, default=repr).encode(),
+            digest_size=16,
+        ).hexdigest()
+        return [self._source_hash(unquote(image[0])), operations, settings_hash]
+
+    def is_up_to_date(self, image, settings):
+        """Return True if the derivative exists and is up to date."""
+        destination = unquote(image[1])
+        if destination not in self.derivatives or not os.path.exists(destination):
+            return False
+        try:
+            return self.derivatives[destination] == self._entry(image, settings)
+        except FileNotFoundError:
+            return False
+
+    def record(self, image, settings):
+        """Record that the derivative has just been generated."""
+        self.derivatives[unquote(image[1])] = self._entry(image, settings)
+        self.changed = True
+
+    def save(self):
+        """Write the manifest if it changed."""
+        if not self.changed:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"sources": self.sources, "derivatives": self.derivatives}, f)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+# Manifests loaded during the build, by path.
+_manifests = {}
+
+
+def get_manifest(settings):
+    """Return the manifest set by IMAGE_PROCESS_MANIFEST, or None."""
+    path = settings.get("IMAGE_PROCESS_MANIFEST")
+    if path is None:
+        return None
+    if path not in _manifests:
+        _manifests[path] = Manifest(path)
+    return _manifests[path]
+
+
+def save_manifests(pelican):
+    """Write the manifests updated during the build."""
+    for manifest in _manifests.values():
+        manifest.save()
+    _manifests.clear()
+
+
+RESAMPLING_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+
+def get_resampling_filter(resample, size, new_size):
+    """Return the Pillow filter to use to resize an image from size to new_size.
+
+    resample is either the name of a filter in RESAMPLING_FILTERS or "auto".
+    With "auto", the BOX filter is used when shrinking the image by an
+    integer factor of at least 2, the BICUBIC filter when shrinking it to
+    no less than half its size, and LANCZOS otherwise.
+    """
+    if resample != "auto":
+        return RESAMPLING_FILTERS[resample]
+
+    if all(n and s >= 2 * n and s % n == 0 for s, n in zip(size, new_size)):
+        return Image.Resampling.BOX
+    if all(s / 2 <= n <= s for s, n in zip(size, new_size)):
+        return Image.Resampling.BICUBIC
+    return Image.Resampling.LANCZOS
+
+
+def convert_length(value, length):
+    """Convert a number or a percentage of length to a float."""
+    if value[-1] == "%":
+        return length * float(value[:-1]) / 100.0
+    return float(value)
 
 
 def convert_box(image, top, left, right, bottom):
-    """Convert box coordinates strings to integer.
+    """Convert box coordinates strings to float.
 
     t, l, r, b (top, left, right, bottom) must be strings specifying
     either a number or a percentage.
     """
-    bbox = image.getbbox()
-    img_width = bbox[2] - bbox[0]
-    img_height = bbox[3] - bbox[1]
-
-    top = img_height * float(top[:-1]) / 100.0 if top[-1] == "%" else float(top)
-    left = img_width * float(left[:-1]) / 100.0 if left[-1] == "%" else float(left)
-    right = img_width * float(right[:-1]) / 100.0 if right[-1] == "%" else float(right)
-    if bottom[-1] == "%":
-        bottom = img_height * float(bottom[:-1]) / 100.0
-    else:
-        bottom = float(bottom)
+    img_width, img_height = image.size
 
-    return top, left, right, bottom
+    return (
+        convert_length(top, img_height),
+        convert_length(left, img_width),
+        convert_length(right, img_width),
+        convert_length(bottom, img_height),
+    )
 
 
-def crop(i, left, top, right, bottom):
-    """Crop image i to the box (left, top)-(right, bottom).
+def get_crop_box(i, left, top, right, bottom):
+    """Return the integer box (left, top, right, bottom) to crop image i to.
 
     left, top, right, bottom must be strings specifying
     either a number or a percentage.
     """
     top, left, right, bottom = convert_box(i, top, left, right, bottom)
-    return i.crop((int(left), int(top), int(right), int(bottom)))
+    return int(left), int(top), int(right), int(bottom)
 
 
-def resize(i, w, h):
-    """Resize the image to the dimension specified.
+def crop(i, left, top, right, bottom):
+    """Crop image i to the box (left, top)-(right, bottom).
 
-    w, h (width, height) must be strings specifying either a number
-    or a percentage.
+    left, top, right, bottom must be strings specifying
+    either a number or a percentage.
     """
-    _, _, w, h = convert_box(i, "0", "0", w, h)
+    return i.crop(get_crop_box(i, left, top, right, bottom))
 
-    if i.mode == "P":
-        i = i.convert("RGBA")
-    elif i.mode == "1":
-        i = i.convert("L")
 
-    return i.resize((int(w), int(h)), Image.Resampling.LANCZOS)
+def get_box_size(i, box):
+    """Return the size of the box region of image i, or of the whole image."""
+    if box is None:
+        return i.size
+    return box[2] - box[0], box[3] - box[1]
 
 
-def scale(i, w, h, upscale, inside):
-    """Resize the image to the dimension specified, keeping the aspect ratio.
+def get_resize_size(size, w, h):
+    """Return the size of an image of size resized to w, h (see resize)."""
+    return int(convert_length(w, size[0])), int(convert_length(h, size[1]))
 
-    w, h (width, height) must be strings specifying either a number
-    or a percentage, or "None" to ignore this constraint.
 
-    If upscale is True, upscaling is allowed.
-
-    If inside is True, the resulting image will not be larger than the
-    dimensions specified, else it will not be smaller.
-    """
-    bbox = i.getbbox()
-    iw = bbox[2] - bbox[0]
-    ih = bbox[3] - bbox[1]
+def get_scale_size(size, w, h, upscale, inside):
+    """Return the size of an image of size scaled to w, h (see scale)."""
+    iw, ih = size
 
     if w == "None":
         w = 1.0
@@ -201,43 +377,116 @@ def scale(i, w, h, upscale, inside):
     if upscale in [0, "0", "False", False]:
         scale = min(scale, 1.0)
 
+    return int(scale * iw), int(scale * ih)
+
+
+def normalize_mode(i):
+    """Convert palette and bilevel images to a mode filters can work on."""
     if i.mode == "P":
-        i = i.convert("RGBA")
-    elif i.mode == "1":
-        i = i.convert("L")
+        return i.convert("RGBA")
+    if i.mode == "1":
+        return i.convert("L")
+    return i
+
 
-    return i.resize((int(scale * iw), int(scale * ih)), Image.Resampling.LANCZOS)
+def resize(i, w, h, resample="lanczos", box=None, reducing_gap=None):  # noqa: PLR0913
+    """Resize the image to the dimension specified.
 
+    w, h (width, height) must be strings specifying either a number
+    or a percentage.
 
-def rotate(i, degrees):
-    if i.mode == "P":
-        i = i.convert("RGBA")
-    elif i.mode == "1":
-        i = i.convert("L")
+    resample is the resampling filter to use (see get_resampling_filter).
+
+    If box is given, only this (left, top, right, bottom) region of the
+    image is resized, as if the image had been cropped to it first.
+
+    If reducing_gap is given, the image is first shrunk by an integer factor
+    with a fast box filter, down to no less than reducing_gap times the
+    requested size (see Image.resize).
+    """
+    i = normalize_mode(i)
+    iw, ih = get_box_size(i, box)
+    new_size = get_resize_size((iw, ih), w, h)
+    return i.resize(
+        new_size,
+        get_resampling_filter(resample, (iw, ih), new_size),
+        box=box,
+        reducing_gap=reducing_gap,
+    )
+
+
+def scale(  # noqa: PLR0913
+    i, w, h, upscale, inside, resample="lanczos", box=None, reducing_gap=None
+):
+    """Resize the image to the dimension specified, keeping the aspect ratio.
+
+    w, h (width, height) must be strings specifying either a number
+    or a percentage, or "None" to ignore this constraint.
+
+    If upscale is True, upscaling is allowed.
 
+    If inside is True, the resulting image will not be larger than the
+    dimensions specified, else it will not be smaller.
+
+    resample is the resampling filter to use (see get_resampling_filter).
+
+    If box is given, only this (left, top, right, bottom) region of the
+    image is resized, as if the image had been cropped to it first.
+
+    If reducing_gap is given, the image is first shrunk by an integer factor
+    with a fast box filter, down to no less than reducing_gap times the
+    requested size (see Image.resize).
+    """
+    i = normalize_mode(i)
+    iw, ih = get_box_size(i, box)
+    new_size = get_scale_size((iw, ih), w, h, upscale, inside)
+    return i.resize(
+        new_size,
+        get_resampling_filter(resample, (iw, ih), new_size),
+        box=box,
+        reducing_gap=reducing_gap,
+    )
+
+
+def rotate(i, degrees):
     # rotate does not support the LANCZOS filter (Pillow 2.7.0).
-    return i.rotate(int(degrees), Image.Resampling.BICUBIC, True)
+    return normalize_mode(i).rotate(int(degrees), Image.Resampling.BICUBIC, True)
 
 
 def apply_filter(i, f):
-    if i.mode == "P":
-        i = i.convert("RGBA")
-    elif i.mode == "1":
-        i = i.convert("L")
+    return normalize_mode(i).filter(f)
+
+
+def box_blur(i, radius):
+    """Blur the image with a box of radius pixels around each pixel.
+
+    Pillow computes box blurs in constant time per pixel whatever the
+    radius, which makes them much cheaper than convolution kernels.
+    """
+    return apply_filter(i, ImageFilter.BoxBlur(float(radius)))
+
+
+def gaussian_blur(i, radius):
+    """Blur the image with a Gaussian of standard deviation radius pixels.
 
-    return i.filter(f)
+    Pillow approximates it with successive box blurs, so its cost does not
+    depend on the radius either.
+    """
+    return apply_filter(i, ImageFilter.GaussianBlur(float(radius)))
 
 
 basic_ops = {
     "crop": crop,
     "flip_horizontal": lambda i: i.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
     "flip_vertical": lambda i: i.transpose(Image.Transpose.FLIP_TOP_BOTTOM),
-    "grayscale": lambda i: i.convert("L"),
+    "grayscale": lambda i: i if i.mode == "L" else i.convert("L"),
     "resize": resize,
     "rotate": rotate,
     "scale_in": functools.partial(scale, inside=True),
     "scale_out": functools.partial(scale, inside=False),
     "blur": functools.partial(apply_filter, f=ImageFilter.BLUR),
+    "box_blur": box_blur,
+    "gaussian_blur": gaussian_blur,
     "contour": functools.partial(apply_filter, f=ImageFilter.CONTOUR),
     "detail": functools.partial(apply_filter, f=ImageFilter.DETAIL),
     "edge_enhance": functools.partial(apply_filter, f=ImageFilter.EDGE_ENHANCE),
@@ -251,6 +500,17 @@ basic_ops = {
     "sharpen": functools.partial(apply_filter, f=ImageFilter.SHARPEN),
 }
 
+# Operations accepting a `resample` argument, with the functions computing
+# the size of the resulting image.
+resampling_ops = {
+    "resize": get_resize_size,
+    "scale_in": functools.partial(get_scale_size, inside=True),
+    "scale_out": functools.partial(get_scale_size, inside=False),
+}
+
+# Modes the JPEG encoder can write.
+jpeg_modes = {"1", "L", "RGB", "RGBX", "CMYK", "YCbCr"}
+
 
 def set_default_settings(settings):
     # Set default value for 'IMAGE_PROCESS'.
@@ -274,51 +534,124 @@ def set_default_settings(settings):
     if "IMAGE_PROCESS_FORCE" not in settings:
         settings["IMAGE_PROCESS_FORCE"] = False
 
+    # Set default value for 'IMAGE_PROCESS_WORKERS'.
+    if "IMAGE_PROCESS_WORKERS" not in settings:
+        settings["IMAGE_PROCESS_WORKERS"] = 1
+
+    # Set default value for 'IMAGE_PROCESS_DEFER'.
+    if "IMAGE_PROCESS_DEFER" not in settings:
+        settings["IMAGE_PROCESS_DEFER"] = False
+
+    # Set default value for 'IMAGE_PROCESS_THREADS'.
+    if "IMAGE_PROCESS_THREADS" not in settings:
+        settings["IMAGE_PROCESS_THREADS"] = False
+
+    # Set default value for 'IMAGE_PROCESS_FORMATS'.
+    if "IMAGE_PROCESS_FORMATS" not in settings:
+        settings["IMAGE_PROCESS_FORMATS"] = []
+
+    for image_format in settings["IMAGE_PROCESS_FORMATS"]:
+        if get_image_format(get_format_extension(image_format)) not in Image.SAVE:
+            raise RuntimeError(
+                f'Image format "{image_format}" of IMAGE_PROCESS_FORMATS cannot be '
+                "written by Pillow."
+            )
+
+    # Set default value for 'IMAGE_PROCESS_SAVE_OPTIONS'.
+    if "IMAGE_PROCESS_SAVE_OPTIONS" not in settings:
+        settings["IMAGE_PROCESS_SAVE_OPTIONS"] = {}
+
+    # Set default value for 'IMAGE_PROCESS_RESAMPLE'.
+    if "IMAGE_PROCESS_RESAMPLE" not in settings:
+        settings["IMAGE_PROCESS_RESAMPLE"] = "lanczos"
+
+    resample = settings["IMAGE_PROCESS_RESAMPLE"]
+    if resample != "auto" and resample not in RESAMPLING_FILTERS:
+        names = ", ".join(["auto", *RESAMPLING_FILTERS])
+        raise RuntimeError(
+            f'Resampling filter "{resample}" of IMAGE_PROCESS_RESAMPLE is not one '
+            f"of: {names}."
+        )
+
+    if "IMAGE_PROCESS_REDUCING_GAP" not in settings:
+        settings["IMAGE_PROCESS_REDUCING_GAP"] = None
+
+    if "IMAGE_PROCESS_DRAFT" not in settings:
+        settings["IMAGE_PROCESS_DRAFT"] = False
+
 
 def harvest_images(path, context):
     set_default_settings(context)
 
     logger.debug("%s harvesting %r", LOG_PREFIX, path)
-    with open(path, "r+", encoding=context["IMAGE_PROCESS_ENCODING"]) as f:
-        res = harvest_images_in_fragment(f, context)
-        f.seek(0)
-        f.truncate()
-        f.write(res)
+    encoding = context["IMAGE_PROCESS_ENCODING"]
+    with open(path, encoding=encoding) as f:
+        fragment = f.read()
+
+    res = harvest_images_in_fragment(fragment, context)
+    if res is not fragment:
+        replace_file(path, res, encoding)
 
 
 def harvest_feed_images(path, context, feed):
     set_default_settings(context)
 
-    with open(path, "r+", encoding=context["IMAGE_PROCESS_ENCODING"]) as f:
-        soup = BeautifulSoup(f, "xml")
+    encoding = context["IMAGE_PROCESS_ENCODING"]
+    with open(path, encoding=encoding) as f:
+        text = f.read()
+    if IMAGE_PROCESS_PREFIX not in text:
+        # No entry uses the plugin, spare parsing the feed.
+        return
 
-        for content in soup.find_all("content"):
-            if content["type"] != "html" or not content.string:
-                continue
+    soup = BeautifulSoup(text, "xml")
+    changed = False
+    for content in soup.find_all("content"):
+        if content["type"] != "html" or not content.string:
+            continue
 
-            doc = html.unescape(content.string)
-            res = harvest_images_in_fragment(doc, context)
+        doc = html.unescape(content.string)
+        res = harvest_images_in_fragment(doc, context)
+        if res is not doc:
             content.string = res
-        f.seek(0)
-        f.truncate()
-        f.write(str(soup))
+            changed = True
+
+    if changed:
+        replace_file(path, str(soup), encoding)
+
+
+def replace_file(path, content, encoding):
+    """Replace the content of a file at once, it is never seen half written."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding=encoding) as f:
+        f.write(content)
+    # Keep the permissions of the file, e.g. for the web server to read it.
+    shutil.copymode(path, tmp_path)
+    os.replace(tmp_path, path)
 
 
 def harvest_images_in_fragment(fragment, settings):
-    parser = settings.get("IMAGE_PROCESS_PARSER", "html.parser")
+    if hasattr(fragment, "read"):
+        fragment = fragment.read()
+
+    if IMAGE_PROCESS_PREFIX not in fragment:
+        # No image to process, spare parsing the document at all.
+        return fragment
+
+    parser = settings.get("IMAGE_PROCESS_PARSER", "lxml")
     soup = BeautifulSoup(fragment, parser)
 
-    copy_exif_tags = settings.get("IMAGE_PROCESS_COPY_EXIF_TAGS", False)
-    if copy_exif_tags:
-        ExifTool.start_exiftool()
+    # Images to generate are collected while walking the document and
+    # processed as a single batch afterwards.
+    images = []
+    imgs = soup.find_all("img", class_=is_image_process_class)
+    if not imgs:
+        # Nothing to change, spare serializing the document again.
+        return fragment
 
-    for img in soup.find_all("img", class_=IMAGE_PROCESS_REGEX):
-        for c in img["class"]:
-            if c.startswith("image-process-"):
-                derivative = c[14:]
-                break
-        else:
-            continue
+    file_index = build_file_index(settings)
+    for img in imgs:
+        derivative = next(c for c in img["class"] if is_image_process_class(c))
+        derivative = derivative[len(IMAGE_PROCESS_PREFIX) :]
 
         try:
             d = settings["IMAGE_PROCESS"][derivative]
@@ -327,7 +660,7 @@ def harvest_images_in_fragment(fragment, settings):
 
         if isinstance(d, list):
             # Single source image specification.
-            process_img_tag(img, settings, derivative)
+            images.extend(process_img_tag(img, settings, derivative, file_index))
 
         elif not isinstance(d, dict):
             raise TypeError(
@@ -340,57 +673,118 @@ def harvest_images_in_fragment(fragment, settings):
 
         elif d["type"] == "image":
             # Single source image specification.
-            process_img_tag(img, settings, derivative)
+            images.extend(process_img_tag(img, settings, derivative, file_index))
 
         elif d["type"] == "responsive-image" and "srcset" not in img.attrs:
             # srcset image specification.
-            build_srcset(img, settings, derivative)
+            images.extend(build_srcset(img, settings, derivative, file_index))
 
         elif d["type"] == "picture":
             # Multiple source (picture) specification.
             group = img.find_parent()
             if group.name == "div":
-                convert_div_to_picture_tag(soup, img, group, settings, derivative)
+                images.extend(
+                    convert_div_to_picture_tag(soup, img, group, settings, derivative)
+                )
             elif group.name == "picture":
-                process_picture(soup, img, group, settings, derivative)
+                images.extend(process_picture(soup, img, group, settings, derivative))
 
-    ExifTool.stop_exiftool()
+    if settings["IMAGE_PROCESS_DEFER"]:
+        # Processed along with the images of all other pages at the end of
+        # the build, see process_deferred_images.
+        _deferred_images.extend(images)
+    else:
+        process_images(images, settings)
+
+    if not DOCUMENT_TAGS_REGEX.match(fragment):
+        # Remove the <html>, <head> and <body> tags added by the parser. They
+        # can only be found at the top of the document: once <html> is
+        # unwrapped, <head> and <body> are top-level too.
+        for name in DOCUMENT_TAGS:
+            tag = soup.find(name, recursive=False)
+            if tag is not None:
+                tag.unwrap()
     return str(soup)
 
 
-def compute_paths(img, settings, derivative):
-    process_dir = settings["IMAGE_PROCESS_DIR"]
-    img_src = urlparse(img["src"])
-    img_src_path = url2pathname(img_src.path.lstrip("/"))
-    img_src_dirname, filename = os.path.split(img_src_path)
-    derivative_path = os.path.join(process_dir, derivative)
-    # urljoin truncates leading ../ elements
-    base_url = posixpath.join(
-        posixpath.dirname(img["src"]), pathname2url(derivative_path)
+def is_image_process_class(css_class):
+    """Return True if css_class selects a derivative image.
+
+    This is used as a Beautiful Soup filter, a plain prefix test being
+    faster than matching a regular expression against every class. Beautiful
+    Soup also tries the whole class attribute, which must not match when
+    none of its classes does, hence the rejection of whitespace.
+    """
+    return (
+        css_class is not None
+        and len(css_class) > len(IMAGE_PROCESS_PREFIX)
+        and css_class.startswith(IMAGE_PROCESS_PREFIX)
+        and css_class.split() == [css_class]
     )
 
+
+# Static file indexes, kept for the whole build. They are keyed by the
+# identity and the size of the indexed dict, which Pelican fills before
+# pages are written.
+_file_indexes = {}
+
+
+def build_file_index(settings):
+    """Index the static files of the site by the name of their output file.
+
+    Returns a dict mapping file names to lists of (save_as, content) tuples.
+    """
     PELICAN_V4 = 4
     if pelican_version != "unknown" and int(pelican_version.split(".")[0]) < PELICAN_V4:
         file_paths = settings["filenames"]
     else:
         file_paths = settings["static_content"]
 
-    for _f, contobj in file_paths.items():
+    key = (id(file_paths), len(file_paths))
+    if key not in _file_indexes:
+        _file_indexes.clear()
+        # Keeping a reference to the dict ensures its id is not reused.
+        _file_indexes[key] = (file_paths, _build_file_index(file_paths))
+    return _file_indexes[key][1]
+
+
+def _build_file_index(file_paths):
+    file_index = collections.defaultdict(list)
+    for contobj in file_paths.values():
         save_as = contobj.get_url_setting("save_as")
         # save_as can be set to empty string, which would match everything
-        if save_as and img_src_path.endswith(save_as):
+        if save_as:
+            file_index[os.path.basename(save_as)].append((save_as, contobj))
+    return file_index
+
+
+def compute_paths(img, settings, derivative, file_index=None):
+    if file_index is None:
+        file_index = build_file_index(settings)
+
+    process_dir = settings["IMAGE_PROCESS_DIR"]
+    img_src = urlparse(img["src"])
+    img_src_path = url2pathname(img_src.path.lstrip("/"))
+    img_src_dirname, filename = os.path.split(img_src_path)
+    derivative_path = os.path.join(process_dir, derivative)
+    # urljoin truncates leading ../ elements
+    base_url = posixpath.join(
+        posixpath.dirname(img["src"]), pathname2url(derivative_path)
+    )
+
+    for save_as, contobj in file_index.get(filename, ()):
+        if img_src_path.endswith(save_as):
             source = contobj.source_path
             base_path = os.path.join(
                 contobj.settings["OUTPUT_PATH"],
-                os.path.dirname(contobj.get_url_setting("save_as")),
+                os.path.dirname(save_as),
                 process_dir,
                 derivative,
             )
             break
     else:
         if "SITEURL" in settings:
-            site_url = urlparse(settings["SITEURL"])
-            site_url_path = url2pathname(site_url.path[1:])
+            site_url_path = get_site_url_path(settings["SITEURL"])
         else:
             # if SITEURL is undefined, don't break!
             site_url_path = None
@@ -407,15 +801,21 @@ def compute_paths(img, settings, derivative):
     return Path(base_url, source, base_path, filename)
 
 
-def process_img_tag(img, settings, derivative):
-    path = compute_paths(img, settings, derivative)
+@functools.lru_cache(maxsize=None)
+def get_site_url_path(site_url):
+    """Return the path of the site URL, parsed once rather than for every tag."""
+    return url2pathname(urlparse(site_url).path[1:])
+
+
+def process_img_tag(img, settings, derivative, file_index=None):
+    path = compute_paths(img, settings, derivative, file_index)
     if not is_img_identifiable(path.source):
         logger.warning(
             "%s Skipping image %s that could not be identified by Pillow",
             LOG_PREFIX,
             path.source,
         )
-        return
+        return []
     process = settings["IMAGE_PROCESS"][derivative]
 
     img["src"] = posixpath.join(path.base_url, path.filename)
@@ -424,28 +824,31 @@ def process_img_tag(img, settings, derivative):
     if not isinstance(process, list):
         process = process["ops"]
 
-    process_image((path.source, destination, process), settings)
+    return [(path.source, destination, process)]
 
 
+@functools.lru_cache(maxsize=None)
 def is_img_identifiable(img_filepath):
+    """Tell if Pillow can open an image, once per build for each image."""
     try:
-        Image.open(img_filepath)
-        return True  # noqa: TRY300
+        with Image.open(img_filepath):
+            return True
     except (FileNotFoundError, UnidentifiedImageError):
         return False
 
 
-def build_srcset(img, settings, derivative):
-    path = compute_paths(img, settings, derivative)
+def build_srcset(img, settings, derivative, file_index=None):
+    path = compute_paths(img, settings, derivative, file_index)
     if not is_img_identifiable(path.source):
         logger.warning(
             "%s Skipping image %s that could not be identified by Pillow",
             LOG_PREFIX,
             path.source,
         )
-        return
+        return []
     process = settings["IMAGE_PROCESS"][derivative]
 
+    images = []
     default = process["default"]
     default_name = ""
     if isinstance(default, str):
@@ -461,7 +864,7 @@ def build_srcset(img, settings, derivative):
     elif isinstance(default, list):
         default_name = "default"
         destination = os.path.join(path.base_path, default_name, path.filename)
-        process_image((path.source, destination, default), settings)
+        images.append((path.source, destination, default))
 
     img["src"] = posixpath.join(path.base_url, default_name, path.filename)
 
@@ -470,14 +873,15 @@ def build_srcset(img, settings, derivative):
 
     srcset = []
     for src in process["srcset"]:
-        file_path = posixpath.join(path.base_url, src[0], path.filename)
-        srcset.append(f"{file_path} {src[0]}")
+        srcset.append(f"{path.base_url}/{src[0]}/{path.filename} {src[0]}")
         destination = os.path.join(path.base_path, src[0], path.filename)
-        process_image((path.source, destination, src[1]), settings)
+        images.append((path.source, destination, src[1]))
 
     if len(srcset) > 0:
         img["srcset"] = ", ".join(srcset)
 
+    return images
+
 
 def convert_div_to_picture_tag(soup, img, group, settings, derivative):
     """Convert a div containing multiple images to a picture."""
@@ -486,20 +890,25 @@ def convert_div_to_picture_tag(soup, img, group, settings, derivative):
     # image URL. Other sources use the img with classes
     # [source['name'], 'image-process'].  We also remove the img from
     # the DOM.
-    sources = copy.deepcopy(settings["IMAGE_PROCESS"][derivative]["sources"])
+    images = []
+    # Only the top-level keys of the sources are modified, the transformations
+    # are shared with the settings.
+    sources = [dict(s) for s in settings["IMAGE_PROCESS"][derivative]["sources"]]
+    # Walk the group only once, rather than once per source.
+    candidates = group.find_all("img", class_="image-process")
     for s in sources:
         if s["name"] == "default":
             s["url"] = img["src"]
         else:
-            candidates = group.find_all("img", class_=s["name"])
-            for candidate in candidates:
-                if "image-process" in candidate["class"]:
+            for n, candidate in enumerate(candidates):
+                if s["name"] in candidate["class"]:
                     s["url"] = candidate["src"]
+                    del candidates[n]
                     candidate.decompose()
                     break
 
-        url_path, s["filename"] = os.path.split(s["url"])
-        s["base_url"] = os.path.join(url_path, process_dir, derivative)
+        url_path, s["filename"] = posixpath.split(s["url"])
+        s["base_url"] = posixpath.join(url_path, process_dir, derivative)
         s["base_path"] = os.path.join(settings["OUTPUT_PATH"], s["base_url"][1:])
 
     # If default is not None, change default img source to the image
@@ -533,7 +942,7 @@ def convert_div_to_picture_tag(soup, img, group, settings, derivative):
                 default_item_name,
                 default_source["filename"],
             )
-            process_image((source, destination, default[1]), settings)
+            images.append((source, destination, default[1]))
         else:
             raise RuntimeError(
                 "Unexpected type for the second value of tuple "
@@ -542,7 +951,7 @@ def convert_div_to_picture_tag(soup, img, group, settings, derivative):
             )
 
         # Change img src to url of default processed image.
-        img["src"] = os.path.join(
+        img["src"] = posixpath.join(
             default_source["base_url"],
             default_source_name,
             default_item_name,
@@ -556,27 +965,25 @@ def convert_div_to_picture_tag(soup, img, group, settings, derivative):
         source_attrs = {k: s[k] for k in s if k in ["media", "sizes"]}
         source_tag = soup.new_tag("source", **source_attrs)
 
-        srcset = []
-        for src in s["srcset"]:
-            srcset.append(
-                "{} {}".format(
-                    os.path.join(s["base_url"], s["name"], src[0], s["filename"]),
-                    src[0],
-                )
-            )
-
-            source = os.path.join(settings["PATH"], s["url"][1:])
-            destination = os.path.join(s["base_path"], s["name"], src[0], s["filename"])
-            process_image((source, destination, src[1]), settings)
+        srcset, variants = build_source_srcsets(s, settings, images)
 
         if len(srcset) > 0:
             source_tag["srcset"] = ", ".join(srcset)
 
+        # Browsers use the first <source> whose type they support.
+        for _, mime_type, variant_srcset in variants:
+            if len(variant_srcset) > 0:
+                variant_tag = soup.new_tag("source", type=mime_type, **source_attrs)
+                variant_tag["srcset"] = ", ".join(variant_srcset)
+                picture_tag.append(variant_tag)
+
         picture_tag.append(source_tag)
 
     # Wrap img with <picture>
     img.wrap(picture_tag)
 
+    return images
+
 
 def process_picture(soup, img, group, settings, derivative):
     """Convert a simplified picture to a full HTML picture. See following example.
@@ -602,7 +1009,10 @@ def process_picture(soup, img, group, settings, derivative):
     # Compile sources URL. Special source "default" uses the main
     # image URL. Other sources use the <source> with classes
     # source['name'].  We also remove the <source>s from the DOM.
-    sources = copy.deepcopy(process["sources"])
+    images = []
+    # Only the top-level keys of the sources are modified, the transformations
+    # are shared with the settings.
+    sources = [dict(s) for s in process["sources"]]
     for s in sources:
         if s["name"] == "default":
             s["url"] = img["src"]
@@ -614,7 +1024,7 @@ def process_picture(soup, img, group, settings, derivative):
             del s["element"]["src"]
             del s["element"]["class"]
 
-        url_path, s["filename"] = os.path.split(s["url"])
+        url_path, s["filename"] = posixpath.split(s["url"])
         s["base_url"] = posixpath.join(url_path, process_dir, derivative)
         s["base_path"] = os.path.join(settings["OUTPUT_PATH"], s["base_url"][1:])
 
@@ -649,7 +1059,7 @@ def process_picture(soup, img, group, settings, derivative):
                 default_source["filename"],
             )
 
-            process_image((source, destination, default[1]), settings)
+            images.append((source, destination, default[1]))
 
         else:
             raise RuntimeError(
@@ -668,28 +1078,308 @@ def process_picture(soup, img, group, settings, derivative):
 
     # Generate srcsets and put back <source>s in <picture>.
     for s in sources:
-        srcset = []
-        for src in s["srcset"]:
-            srcset.append(
-                "{} {}".format(
-                    posixpath.join(s["base_url"], s["name"], src[0], s["filename"]),
-                    src[0],
-                )
-            )
-
-            source = os.path.join(settings["PATH"], s["url"][1:])
-            destination = os.path.join(s["base_path"], s["name"], src[0], s["filename"])
-            process_image((source, destination, src[1]), settings)
+        srcset, variants = build_source_srcsets(s, settings, images)
 
         if len(srcset) > 0:
+            # Browsers use the first <source> whose type they support.
+            for _, mime_type, variant_srcset in variants:
+                variant_tag = copy.copy(s["element"])
+                variant_tag["type"] = mime_type
+                variant_tag["srcset"] = ", ".join(variant_srcset)
+                img.insert_before(variant_tag)
+
             # Append source elements to the picture in the same order
             # as they are found in
             # settings['IMAGE_PROCESS'][derivative]['sources'].
             s["element"]["srcset"] = ", ".join(srcset)
             img.insert_before(s["element"])
 
+    return images
+
+
+def build_source_srcsets(s, settings, images):
+    """Build the srcset of a picture source and of its format variants.
+
+    The (source, destination, operations) jobs generating the images are
+    appended to images.
+    """
+    # These only depend on the source, not on the srcset entry.
+    url_prefix = posixpath.join(s["base_url"], s["name"])
+    path_prefix = os.path.join(s["base_path"], s["name"])
+    filename = s["filename"]
+    source = os.path.join(settings["PATH"], s["url"][1:])
+
+    srcset = []
+    variants = get_format_variants(settings, filename)
+    for src in s["srcset"]:
+        srcset.append(f"{url_prefix}/{src[0]}/{filename} {src[0]}")
+        destination = os.path.join(path_prefix, src[0], filename)
+        images.append((source, destination, src[1]))
+        for variant, _, variant_srcset in variants:
+            variant_srcset.append(f"{url_prefix}/{src[0]}/{variant} {src[0]}")
+            destination = os.path.join(path_prefix, src[0], variant)
+            images.append((source, destination, src[1]))
+
+    return srcset, variants
+
+
+def get_format_variants(settings, filename):
+    """Return the variants of filename in the IMAGE_PROCESS_FORMATS formats.
+
+    Each variant is a (filename, MIME type, srcset) tuple, the srcset being
+    an empty list to be filled by the caller.
+    """
+    name, ext = os.path.splitext(filename)
+    variants = []
+    for image_format in settings["IMAGE_PROCESS_FORMATS"]:
+        variant_ext = get_format_extension(image_format)
+        if variant_ext == ext.lower():
+            continue
+        mime_type = Image.MIME[get_image_format(variant_ext)]
+        variants.append((name + variant_ext, mime_type, []))
+    return variants
+
+
+def get_format_extension(image_format):
+    """Return the file extension of an IMAGE_PROCESS_FORMATS entry."""
+    return "." + image_format.lower().lstrip(".")
+
+
+def get_image_format(path):
+    """Return the Pillow format of an image file by its extension, or None."""
+    ext = os.path.splitext(path)[1] or path
+    return Image.registered_extensions().get(ext.lower())
+
+
+def process_images(images, settings):
+    """Generate a batch of derivative images.
+
+    images is a list of (source, destination, operations) tuples, images
+    sharing the same destination being generated only once, by the first
+    of them. With the default of a single worker, images are processed one
+    after the other. Otherwise they are dispatched to a process pool, or to
+    a thread pool when some operations (e.g. lambdas) cannot be sent to
+    worker processes.
+    """
+    unique_images = {}
+    for image in images:
+        unique_images.setdefault(image[1], image)
+    images = list(unique_images.values())
+
+    manifest = get_manifest(settings)
+    if manifest is not None:
+        # The manifest tells which derivatives are up to date, rather than
+        # the modification times of the files.
+        if not settings["IMAGE_PROCESS_FORCE"]:
+            images = [
+                image for image in images if not manifest.is_up_to_date(image, settings)
+            ]
+        settings = {**settings, "IMAGE_PROCESS_FORCE": True}
+
+    copy_exif_tags = settings.get("IMAGE_PROCESS_COPY_EXIF_TAGS", False)
+    if copy_exif_tags:
+        ExifTool.start_exiftool()
+
+    _clear_caches()
+    try:
+        _process_images(images, settings)
+    finally:
+        _clear_caches()
+        ExifTool.stop_exiftool()
+
+    if manifest is not None:
+        for image in images:
+            manifest.record(image, settings)
+
+
+# Images collected from all pages when IMAGE_PROCESS_DEFER is enabled.
+_deferred_images = []
+
+
+def process_deferred_images(pelican):
+    """Generate the images collected from all pages as a single batch.
+
+    An image referenced from several pages is only generated once.
+    """
+    # Pages often share source images. Their derivatives are generated one
+    # after the other, while the decoded source is still cached.
+    images = list(itertools.chain.from_iterable(group_by_source(_deferred_images)))
+    _deferred_images.clear()
+    if images:
+        set_default_settings(pelican.settings)
+        process_images(images, pelican.settings)
+
+
+def _process_images(images, settings):
+    workers = settings["IMAGE_PROCESS_WORKERS"]
+    if workers == 1 or len(images) < 2:  # noqa: PLR2004
+        for image in images:
+            process_image(image, settings)
+        return
+
+    # Only the plugin settings are needed by workers. The transformations
+    # themselves travel with each image.
+    worker_settings = {
+        k: v
+        for k, v in settings.items()
+        if k.startswith("IMAGE_PROCESS_") and k != "IMAGE_PROCESS_WORKERS"
+    }
+    # Create the destination directories once, rather than from every
+    # worker.
+    for path in {os.path.dirname(unquote(image[1])) for image in images}:
+        _make_dirs(path)
+
+    if settings["IMAGE_PROCESS_THREADS"]:
+        executor_class = ThreadPoolExecutor
+    else:
+        try:
+            pickle.dumps(images)
+            executor_class = ProcessPoolExecutor
+        except (pickle.PicklingError, AttributeError, TypeError):
+            executor_class = ThreadPoolExecutor
+
+    # Derivatives of the same source image are generated by the same worker,
+    # which only decodes the source once.
+    groups = group_by_source(images)
+
+    process = functools.partial(
+        _process_image_group,
+        settings=worker_settings,
+        clear_caches=executor_class is ProcessPoolExecutor,
+    )
+    # Send jobs to worker processes in chunks, which saves round trips while
+    # still spreading them evenly.
+    chunksize = max(1, len(groups) // (4 * (workers or os.cpu_count() or 1)))
+    executor = get_executor(executor_class, workers)
+    try:
+        processed = list(executor.map(process, groups, chunksize=chunksize))
+    except BrokenExecutor:
+        # A worker died: the next batch starts a new pool.
+        del _executors[executor_class, workers]
+        raise
+
+    images = itertools.chain.from_iterable(groups)
+    for image, was_processed in zip(images, itertools.chain(*processed)):
+        if was_processed:
+            _mtimes.pop(unquote(image[1]), None)
+            ExifTool.copy_tags(unquote(image[0]), unquote(image[1]))
+
+
+def group_by_source(images):
+    """Group images by source, in the order the sources first appear."""
+    groups = collections.defaultdict(list)
+    for image in images:
+        groups[image[0]].append(image)
+    return list(groups.values())
+
+
+# Pools of workers, by executor class and number of workers. They are
+# started by the first batch using them and kept until the end of the build,
+# rather than started again for the images of every page.
+_executors = {}
+
+
+def get_executor(executor_class, workers):
+    """Return the pool of workers of executor_class, starting it if needed."""
+    key = (executor_class, workers)
+    if key not in _executors:
+        _executors[key] = executor_class(max_workers=workers)
+    return _executors[key]
+
+
+def shutdown_executors(pelican):
+    """Stop the pools of workers started during the build."""
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
+
+
+def _process_image_group(images, settings, clear_caches=False):
+    # EXIF tags are copied afterwards from the main process, which owns the
+    # exiftool instance. Destination directories were created by the main
+    # process too.
+    try:
+        return [
+            process_image(image, settings, copy_exif_tags=False, make_dirs=False)
+            for image in images
+        ]
+    finally:
+        # Worker processes are kept between batches: they must not keep the
+        # decoded images of the group in memory.
+        if clear_caches:
+            _clear_caches()
+
+
+def _clear_caches():
+    # Decoded images must not be kept in memory between batches, nor existing
+    # directories which could change before the next one.
+    _open_source_image.cache_clear()
+    _source_info.cache_clear()
+    _make_dirs.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _make_dirs(path):
+    """Create a destination directory, once per batch."""
+    os.makedirs(path, exist_ok=True)
+
+
+# Modification times of source and derivative images. They are kept for the
+# whole build, as the same images are often referenced from several pages.
+_mtimes = {}
+
+
+def _mtime(path):
+    """Return the modification time of path, or None if it does not exist."""
+    try:
+        return _mtimes[path]
+    except KeyError:
+        pass
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    _mtimes[path] = mtime
+    return mtime
+
+
+def clear_build_caches(pelican):
+    """Forget what was recorded about the files of the site during the build."""
+    _mtimes.clear()
+    _file_indexes.clear()
+    is_img_identifiable.cache_clear()
+
+
+@functools.lru_cache(maxsize=4)
+def _open_source_image(path, draft_size=None):
+    """Open and decode a source image.
+
+    A source image usually has several derivatives (srcset breakpoints,
+    picture sources), so the decoded images are cached to be decoded only
+    once. Callers must transform a copy of the returned image.
+
+    If draft_size is given, JPEG images are decoded at the smallest scale
+    (1/2, 1/4 or 1/8) still larger than this size.
+    """
+    with Image.open(path) as i:
+        if draft_size is not None:
+            i.draft(i.mode, draft_size)
+        i.load()
+    return i
+
+
+@functools.lru_cache(maxsize=None)
+def _source_info(path):
+    """Return the format and size of a source image, read from its header."""
+    with Image.open(path) as i:
+        return i.format, i.size
+
+
+def process_image(image, settings, copy_exif_tags=True, make_dirs=True):
+    """Generate a derivative image, return True if it was (re)generated.
 
-def process_image(image, settings):
+    If make_dirs is False, the destination directory must already exist.
+    """
     # remove URL encoding to get to physical filenames
     image = list(image)
     image[0] = unquote(image[0])
@@ -698,31 +1388,133 @@ def process_image(image, settings):
 
     logger.debug(f"{LOG_PREFIX} {image[0]} -> {image[1]}")
 
-    os.makedirs(os.path.dirname(image[1]), exist_ok=True)
-
     # If original image is older than existing derivative, skip
     # processing to save time, unless user explicitly forced
     # image generation.
+    if not settings["IMAGE_PROCESS_FORCE"]:
+        source_mtime = _mtime(image[0])
+        destination_mtime = _mtime(image[1])
+        if (
+            source_mtime is not None
+            and destination_mtime is not None
+            and source_mtime <= destination_mtime
+        ):
+            return False
+
+    if make_dirs:
+        _make_dirs(os.path.dirname(image[1]))
+
+    try:
+        steps = parse_operations(tuple(image[2]))
+    except TypeError:
+        # Some custom operations are not hashable.
+        steps = parse_operations.__wrapped__(image[2])
+
+    draft_size = None
     if (
-        settings["IMAGE_PROCESS_FORCE"]
-        or not os.path.exists(image[1])
-        or os.path.getmtime(image[0]) > os.path.getmtime(image[1])
+        settings["IMAGE_PROCESS_DRAFT"]
+        and is_resizing_step(steps, 0)
+        and _source_info(image[0])[0] == "JPEG"
     ):
-        i = Image.open(image[0])
+        # The image is resized first: no need to decode all its pixels.
+        # The first step becomes a plain resize to the size computed from
+        # the full image, since the decoded image will be smaller.
+        # Only JPEG images can be drafted: for other formats, a draft size
+        # would only cause the source to be decoded again for each size.
+        source_size = _source_info(image[0])[1]
+        size = resampling_ops[steps[0].name](source_size, *steps[0].args)
+        if size[0] > 0 and size[1] > 0:
+            draft_size = (2 * size[0], 2 * size[1])
+            steps = (
+                Operation("resize", basic_ops["resize"], tuple(map(str, size))),
+                *steps[1:],
+            )
 
-        for step in image[2]:
-            if callable(step):
-                i = step(i)
-            else:
-                elems = step.split(" ")
-                i = basic_ops[elems[0]](i, *(elems[1:]))
+    i = _open_source_image(image[0], draft_size).copy()
 
-        # `save_all=True`  will allow saving multi-page (aka animated) GIF's
-        # however, turning it on seems to break PNG support, and doesn't seem
-        # to work on GIF's either...
-        i.save(image[1], progressive=True)
+    resample = settings["IMAGE_PROCESS_RESAMPLE"]
+    reducing_gap = settings["IMAGE_PROCESS_REDUCING_GAP"]
+    box = None
+    for n, step in enumerate(steps):
+        if callable(step):
+            i = step(i)
+            continue
+        if step.name == "crop" and is_resizing_step(steps, n + 1):
+            # Let the next step resize the cropped region directly instead
+            # of creating an intermediate cropped image.
+            box = get_crop_box(i, *step.args)
+            if not is_inside(box, i.size):
+                i = i.crop(box)
+                box = None
+        elif step.name in resampling_ops:
+            i = step.function(
+                i,
+                *step.args,
+                resample=resample,
+                box=box,
+                reducing_gap=reducing_gap,
+            )
+            box = None
+        else:
+            i = step.function(i, *step.args)
+
+    # `save_all=True`  will allow saving multi-page (aka animated) GIF's
+    # however, turning it on seems to break PNG support, and doesn't seem
+    # to work on GIF's either...
+    if get_image_format(image[1]) == "JPEG" and i.mode not in jpeg_modes:
+        # JPEG has no alpha channel nor palette, e.g. for a JPEG variant of
+        # a transparent PNG image.
+        i = i.convert("RGB")
+    i.save(image[1], **get_save_options(settings, image[1]))
+    _mtimes.pop(image[1], None)
 
+    if copy_exif_tags:
         ExifTool.copy_tags(image[0], image[1])
+    return True
+
+
+def get_save_options(settings, path):
+    """Return the keyword arguments to save the image at path with.
+
+    Options given in IMAGE_PROCESS_SAVE_OPTIONS for the format of the
+    image, e.g. "JPEG", are added to or override the default ones.
+    """
+    options = {"progressive": True}
+    image_format = get_image_format(path)
+    options.update(settings["IMAGE_PROCESS_SAVE_OPTIONS"].get(image_format, {}))
+    return options
+
+
+@functools.lru_cache(maxsize=None)
+def parse_operations(operations):
+    """Parse each operation into an Operation, with its function and arguments.
+
+    Custom operations (callables) are kept as they are. The same
+    transformation being applied to many images, it is parsed only once.
+    """
+    return tuple(
+        step if callable(step) else parse_operation(step) for step in operations
+    )
+
+
+def parse_operation(operation):
+    name, *args = operation.split(" ")
+    try:
+        function = basic_ops[name]
+    except KeyError as e:
+        raise RuntimeError(f"Operation {name} undefined.") from e
+    return Operation(name, function, tuple(args))
+
+
+def is_resizing_step(steps, n):
+    """Return True if steps[n] exists and is a resizing operation."""
+    return n < len(steps) and not callable(steps[n]) and steps[n].name in resampling_ops
+
+
+def is_inside(box, size):
+    """Return True if box is a non-empty region inside an image of size."""
+    left, top, right, bottom = box
+    return 0 <= left < right <= size[0] and 0 <= top < bottom <= size[1]
 
 
 def dump_config(pelican):
@@ -736,6 +1528,28 @@ def dump_config(pelican):
 
 
 def register():
+    # Pillow-SIMD is a drop-in replacement for Pillow, versioned with a
+    # ".postN" suffix, that speeds up resampling and filters.
+    if ".post" in PIL.__version__:
+        logger.debug("%s Using Pillow-SIMD %s.", LOG_PREFIX, PIL.__version__)
+    else:
+        logger.debug(
+            "%s Using Pillow %s. Installing Pillow-SIMD instead, compiled for "
+            "AVX2 if your processor supports it, would speed up image resizing "
+            "and filtering.",
+            LOG_PREFIX,
+            PIL.__version__,
+        )
+    if not features.check_feature("libjpeg_turbo"):
+        logger.debug(
+            "%s Pillow was built without libjpeg-turbo, JPEG images are "
+            "decoded and encoded more slowly.",
+            LOG_PREFIX,
+        )
     signals.content_written.connect(harvest_images)
     signals.feed_written.connect(harvest_feed_images)
+    signals.finalized.connect(process_deferred_images)
     signals.finalized.connect(dump_config)
+    signals.finalized.connect(save_manifests)
+    signals.finalized.connect(shutdown_executors)
+    signals.finalized.connect(clear_build_caches)
@@ -1,20 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import io
 import json
 import os
 from pathlib import Path
 import shutil
 import subprocess
+from types import SimpleNamespace
 import warnings
 
-from PIL import Image, ImageChops
+from bs4 import BeautifulSoup
+from PIL import Image, ImageChops, ImageStat, JpegImagePlugin
 import pytest
 
 from pelican.plugins.image_process import (
+    IMAGE_PROCESS_REGEX,
     ExifTool,
+    basic_ops,
+    clear_build_caches,
     compute_paths,
+    convert_box,
+    get_format_variants,
+    get_resampling_filter,
+    get_save_options,
+    harvest_feed_images,
+    harvest_images,
     harvest_images_in_fragment,
     is_img_identifiable,
+    parse_operations,
+    process_deferred_images,
     process_image,
+    process_images,
+    save_manifests,
     set_default_settings,
+    shutdown_executors,
 )
 
 # Prepare test image constants.
@@ -40,6 +59,8 @@ SINGLE_TRANSFORMS = {
     "scale_in": ["scale_in 200 250 False"],
     "scale_out": ["scale_out 200 250 False"],
     "blur": ["blur"],
+    "box_blur": ["box_blur 3"],
+    "gaussian_blur": ["gaussian_blur 3"],
     "contour": ["contour"],
     "detail": ["detail"],
     "edge_enhance": ["edge_enhance"],
@@ -71,6 +92,70 @@ def get_settings(**kwargs):
     return settings
 
 
+def test_fragment_without_images_is_unchanged(mocker):
+    fragment = "<p>Some <b>bold<br>text &amp; an <img src='/tmp/test.jpg'>.</p>"
+    assert harvest_images_in_fragment(fragment, get_settings()) is fragment
+
+    # Documents not mentioning the plugin are not even parsed.
+    soup = mocker.patch("pelican.plugins.image_process.image_process.BeautifulSoup")
+    assert harvest_images_in_fragment(fragment, get_settings()) is fragment
+    soup.assert_not_called()
+
+    fragment = '<p class="image-process-note">Some text.</p>'
+    soup.side_effect = BeautifulSoup
+    assert harvest_images_in_fragment(fragment, get_settings()) is fragment
+    soup.assert_called_once()
+
+
+def test_harvest_images(mocker, tmp_path):
+    mocker.patch(
+        "pelican.plugins.image_process.image_process.is_img_identifiable",
+        lambda img_filepath: True,
+    )
+    mocker.patch("pelican.plugins.image_process.image_process.process_image")
+
+    page = tmp_path.joinpath("page.html")
+    page.write_text('<p><img class="image-process-crop" src="/tmp/test.jpg"/></p>')
+    page.chmod(0o604)
+    harvest_images(str(page), get_settings(IMAGE_PROCESS_DIR="derivs"))
+
+    assert page.read_text() == (
+        '<p><img class="image-process-crop" src="/tmp/derivs/crop/test.jpg"/></p>'
+    )
+    assert [p.name for p in tmp_path.iterdir()] == ["page.html"]
+    assert page.stat().st_mode & 0o777 == 0o604  # noqa: PLR2004
+
+
+def test_harvest_feed_images(mocker, tmp_path):
+    mocker.patch(
+        "pelican.plugins.image_process.image_process.is_img_identifiable",
+        lambda img_filepath: True,
+    )
+    mocker.patch("pelican.plugins.image_process.image_process.process_image")
+
+    feed = tmp_path.joinpath("feed.xml")
+    feed.write_text(
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<feed xmlns="http://www.w3.org/2005/Atom"><entry><content type="html">'
+        "&lt;img class=&quot;image-process-crop&quot; "
+        "src=&quot;/tmp/test.jpg&quot;/&gt;</content></entry></feed>"
+    )
+    harvest_feed_images(str(feed), get_settings(IMAGE_PROCESS_DIR="derivs"), None)
+
+    assert "/tmp/derivs/crop/test.jpg" in feed.read_text()
+    assert [p.name for p in tmp_path.iterdir()] == ["feed.xml"]
+
+    # Feeds in which no entry uses the plugin are not even parsed.
+    soup = mocker.patch("pelican.plugins.image_process.image_process.BeautifulSoup")
+    feed.write_text(
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<feed xmlns="http://www.w3.org/2005/Atom"><entry><content type="html">'
+        "&lt;img src=&quot;/tmp/test.jpg&quot;/&gt;</content></entry></feed>"
+    )
+    harvest_feed_images(str(feed), get_settings(IMAGE_PROCESS_DIR="derivs"), None)
+    soup.assert_not_called()
+
+
 def test_undefined_transform():
     settings = get_settings()
     tag = "<img class='image-process-undefined' src='/tmp/test.jpg' />"
@@ -78,6 +163,28 @@ def test_undefined_transform():
         harvest_images_in_fragment(tag, settings)
 
 
+def test_class_must_start_with_prefix(mocker):
+    process = mocker.patch("pelican.plugins.image_process.image_process.process_image")
+    settings = get_settings()
+    tag = '<img class="no-image-process-crop" src="/tmp/test.jpg"/>'
+
+    assert harvest_images_in_fragment(tag, settings) == tag
+    process.assert_not_called()
+
+    # The whole class attribute starts with the prefix, but no class does.
+    tag = '<img class="image-process- foo" src="/tmp/test.jpg"/>'
+    assert harvest_images_in_fragment(tag, settings) == tag
+    process.assert_not_called()
+
+
+def test_image_process_regex_is_still_available():
+    assert IMAGE_PROCESS_REGEX.pattern == "image-process-[-a-zA-Z0-9_]+"
+    assert IMAGE_PROCESS_REGEX.search("image-process-crop").group() == (
+        "image-process-crop"
+    )
+    assert IMAGE_PROCESS_REGEX.search("image-process-") is None
+
+
 @pytest.mark.parametrize("transform_id, transform_params", SINGLE_TRANSFORMS.items())
 @pytest.mark.parametrize("image_path", TEST_IMAGES)
 def test_all_transforms(tmp_path, transform_id, transform_params, image_path):
@@ -97,6 +204,372 @@ def test_all_transforms(tmp_path, transform_id, transform_params, image_path):
     assert image_diff is None
 
 
+def test_process_images_once_per_destination(mocker):
+    process = mocker.patch("pelican.plugins.image_process.image_process.process_image")
+    images = [("a.jpg", "derivs/a.jpg", ["grayscale"])] * 3
+
+    process_images(images, get_settings())
+
+    process.assert_called_once()
+
+    # The first job generating a destination wins.
+    process.reset_mock()
+    images = [
+        ("a.jpg", "d.jpg", ["grayscale"]),
+        ("b.jpg", "e.jpg", []),
+        ("a.jpg", "d.jpg", ["flip_vertical"]),
+    ]
+    process_images(images, get_settings())
+
+    assert [call.args[0] for call in process.mock_calls] == images[:2]
+
+
+def test_convert_box_uses_whole_image():
+    # Black borders must not be excluded from the image size.
+    image = Image.new("RGB", (200, 100))
+    image.paste((255, 255, 255), (50, 25, 150, 75))
+
+    assert convert_box(image, "10%", "25%", "100%", "50") == (10, 50, 200, 50)
+
+
+@pytest.mark.parametrize(
+    "resample, new_size, expected",
+    [
+        ("lanczos", (600, 400), Image.Resampling.LANCZOS),
+        ("box", (100, 100), Image.Resampling.BOX),
+        ("auto", (600, 400), Image.Resampling.BICUBIC),
+        ("auto", (400, 300), Image.Resampling.LANCZOS),
+        ("auto", (500, 375), Image.Resampling.BOX),
+        ("auto", (250, 250), Image.Resampling.BOX),
+        ("auto", (500, 300), Image.Resampling.LANCZOS),
+        ("auto", (1600, 1200), Image.Resampling.LANCZOS),
+    ],
+)
+def test_get_resampling_filter(resample, new_size, expected):
+    assert get_resampling_filter(resample, (1000, 750), new_size) == expected
+
+
+def test_unknown_resampling_filter():
+    with pytest.raises(RuntimeError, match='"lanczo" of IMAGE_PROCESS_RESAMPLE'):
+        get_settings(IMAGE_PROCESS_RESAMPLE="lanczo")
+
+
+@pytest.mark.parametrize(
+    "transforms",
+    [
+        SINGLE_TRANSFORMS,
+        # Lambdas cannot be pickled: a thread pool is used instead.
+        {**SINGLE_TRANSFORMS, "flip_horizontal": [lambda i: i.transpose(0)]},
+    ],
+)
+@pytest.mark.parametrize("threads", [False, True])
+def test_process_images_with_workers(mocker, tmp_path, transforms, threads):
+    """Test that images processed by a pool match the expected results."""
+    settings = get_settings(IMAGE_PROCESS_WORKERS=2, IMAGE_PROCESS_THREADS=threads)
+    if threads:
+        mocker.patch(
+            "pelican.plugins.image_process.image_process.ProcessPoolExecutor",
+            side_effect=AssertionError("A thread pool should be used."),
+        )
+
+    images = [
+        (
+            str(image_path),
+            str(tmp_path.joinpath(transform_id, image_path.name)),
+            transform_params,
+        )
+        for image_path in TEST_IMAGES
+        for transform_id, transform_params in transforms.items()
+    ]
+    process_images(images, settings)
+    shutdown_executors(None)
+
+    for image_path in TEST_IMAGES:
+        for transform_id in transforms:
+            transformed = Image.open(tmp_path.joinpath(transform_id, image_path.name))
+            expected = Image.open(
+                TRANSFORM_RESULTS.joinpath(transform_id, image_path.name)
+            )
+            assert ImageChops.difference(transformed, expected).getbbox() is None
+
+
+def test_pool_is_kept_for_the_build(mocker, tmp_path):
+    executor = mocker.patch(
+        "pelican.plugins.image_process.image_process.ThreadPoolExecutor",
+        wraps=ThreadPoolExecutor,
+    )
+    settings = get_settings(IMAGE_PROCESS_WORKERS=2, IMAGE_PROCESS_THREADS=True)
+
+    for transform_id in ["grayscale", "flip_vertical"]:
+        process_images(
+            [
+                (
+                    str(image_path),
+                    str(tmp_path.joinpath(transform_id, image_path.name)),
+                    [transform_id],
+                )
+                for image_path in TEST_IMAGES
+            ],
+            settings,
+        )
+
+    executor.assert_called_once_with(max_workers=2)
+    shutdown = mocker.spy(ThreadPoolExecutor, "shutdown")
+    shutdown_executors(None)
+    shutdown.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "transform_params, box, size",
+    [
+        (["crop 100 100 500 400", "resize 50% 50%"], (100, 100, 500, 400), (200, 150)),
+        (
+            ["crop 10% 0 90% 50%", "scale_in 200 200 False"],
+            (102, 0, 921, 384),
+            (200, 93),
+        ),
+        # Boxes outside of the image cannot be fused.
+        (["crop -10 0 500 400", "resize 255 200"], (-10, 0, 500, 400), (255, 200)),
+    ],
+)
+def test_crop_and_resize(tmp_path, transform_params, box, size):
+    image_path = TEST_IMAGES[1]
+    destination_path = tmp_path.joinpath(image_path.name)
+    process_image(
+        (str(image_path), str(destination_path), transform_params), get_settings()
+    )
+
+    expected = Image.open(image_path).crop(box).resize(size, Image.Resampling.LANCZOS)
+    transformed = Image.open(destination_path)
+    assert transformed.size == expected.size
+    # Resizing a region of the image instead of a cropped image only changes
+    # pixels along the edges.
+    image_diff = ImageChops.difference(transformed, expected)
+    assert max(ImageStat.Stat(image_diff).mean) < 0.1  # noqa: PLR2004
+
+
+@pytest.mark.parametrize(
+    "transform_params", [["scale_in 200 200 False"], ["resize 100 75"]]
+)
+def test_reducing_gap(tmp_path, transform_params):
+    image_path = TEST_IMAGES[1]
+    exact_path = tmp_path.joinpath("exact.png")
+    reduced_path = tmp_path.joinpath("reduced.png")
+
+    image = (str(image_path), str(exact_path), transform_params)
+    process_image(image, get_settings())
+    image = (str(image_path), str(reduced_path), transform_params)
+    process_image(image, get_settings(IMAGE_PROCESS_REDUCING_GAP=2.0))
+
+    exact = Image.open(exact_path)
+    reduced = Image.open(reduced_path)
+    assert reduced.size == exact.size
+    image_diff = ImageChops.difference(reduced, exact)
+    assert max(ImageStat.Stat(image_diff).mean) < 2  # noqa: PLR2004
+
+
+def test_grayscale_image_is_not_converted_again():
+    image = Image.new("L", (10, 10))
+    assert basic_ops["grayscale"](image) is image
+    assert basic_ops["grayscale"](Image.new("RGB", (10, 10))).mode == "L"
+
+
+def test_parse_operations():
+    def custom(i):
+        return i
+
+    assert parse_operations(("crop 0 0 10 10", custom, "grayscale")) == (
+        ("crop", basic_ops["crop"], ("0", "0", "10", "10")),
+        custom,
+        ("grayscale", basic_ops["grayscale"], ()),
+    )
+
+    with pytest.raises(RuntimeError):
+        parse_operations(("crop 0 0 10 10", "undefined 10"))
+
+
+@pytest.mark.parametrize(
+    "transform_params",
+    [["scale_in 200 200 False"], ["scale_out 100 100 False", "sharpen"]],
+)
+def test_draft(mocker, tmp_path, transform_params):
+    image_path = TEST_IMAGES[0]
+    exact_path = tmp_path.joinpath("exact.jpg")
+    draft_path = tmp_path.joinpath("draft.jpg")
+
+    image = (str(image_path), str(exact_path), transform_params)
+    process_image(image, get_settings())
+    draft = mocker.spy(JpegImagePlugin.JpegImageFile, "draft")
+    image = (str(image_path), str(draft_path), transform_params)
+    process_image(image, get_settings(IMAGE_PROCESS_DRAFT=True))
+
+    assert draft.call_count == 1
+    exact = Image.open(exact_path)
+    drafted = Image.open(draft_path)
+    assert drafted.size == exact.size
+    image_diff = ImageChops.difference(drafted, exact)
+    assert max(ImageStat.Stat(image_diff).mean) < 3  # noqa: PLR2004
+
+
+def test_draft_png_source_is_decoded_once(mocker, tmp_path):
+    source = tmp_path.joinpath("source.png")
+    shutil.copy(TEST_IMAGES[1], source)
+    images = [
+        (
+            str(source),
+            str(tmp_path.joinpath(f"{width}.png")),
+            [f"scale_in {width} {width} False"],
+        )
+        for width in [100, 200, 300, 400]
+    ]
+    load = mocker.spy(Image.Image, "load")
+
+    process_images(images, get_settings(IMAGE_PROCESS_DRAFT=True))
+
+    # Every copy of the decoded image loads it again, which is a no-op.
+    decoded = {
+        id(call.args[0])
+        for call in load.mock_calls
+        if getattr(call.args[0], "filename", None) == str(source)
+    }
+    assert len(decoded) == 1
+
+
+def test_up_to_date_image_is_skipped(tmp_path):
+    image = (str(TEST_IMAGES[0]), str(tmp_path.joinpath("crop.jpg")), ["grayscale"])
+
+    assert process_image(image, get_settings())
+    assert not process_image(image, get_settings())
+    assert process_image(image, get_settings(IMAGE_PROCESS_FORCE=True))
+
+
+@pytest.mark.parametrize(
+    "transform_params, mode",
+    [
+        (["crop 0 0 50% 50%", "flip_horizontal"], "P"),
+        (["crop 0 0 50% 50%", "scale_in 50 50 False"], "RGBA"),
+        (["rotate 90", "sharpen"], "RGBA"),
+    ],
+)
+def test_palette_image_is_converted_when_needed(tmp_path, transform_params, mode):
+    source = tmp_path.joinpath("source.png")
+    Image.open(TEST_IMAGES[1]).convert("P").save(source)
+    destination = tmp_path.joinpath("derivative.png")
+
+    process_image((str(source), str(destination), transform_params), get_settings())
+
+    assert Image.open(destination).mode == mode
+
+
+@pytest.mark.parametrize(
+    "operation, args",
+    [
+        ("resize", ("50", "50")),
+        ("scale_in", ("50", "50", "False")),
+        ("rotate", ("20",)),
+        ("sharpen", ()),
+        ("gaussian_blur", ("2",)),
+    ],
+)
+@pytest.mark.parametrize("mode, expected_mode", [("P", "RGBA"), ("1", "L")])
+def test_operations_convert_palette_images(operation, args, mode, expected_mode):
+    image = Image.open(TEST_IMAGES[0]).convert(mode)
+
+    assert basic_ops[operation](image, *args).mode == expected_mode
+
+
+def test_modification_times_are_kept_for_the_build(mocker, tmp_path):
+    image = (str(TEST_IMAGES[0]), str(tmp_path.joinpath("crop.jpg")), ["grayscale"])
+    settings = get_settings()
+    process_images([image], settings)
+
+    stat = mocker.spy(os, "stat")
+    process_images([image], settings)
+    process_images([image], settings)
+    assert stat.call_count == 1  # The derivative written by the first batch.
+
+    clear_build_caches(None)
+    process_images([image], settings)
+    assert stat.call_count == 3  # noqa: PLR2004
+
+
+def test_manifest(mocker, tmp_path):
+    source = tmp_path.joinpath("source.jpg")
+    shutil.copy(TEST_IMAGES[0], source)
+    destination = tmp_path.joinpath("derivative.jpg")
+    settings = get_settings(IMAGE_PROCESS_MANIFEST=str(tmp_path / "manifest.json"))
+    process = mocker.patch(
+        "pelican.plugins.image_process.image_process.process_image",
+        wraps=process_image,
+    )
+
+    process_images([(str(source), str(destination), ["grayscale"])], settings)
+    assert process.call_count == 1
+    save_manifests(None)
+
+    # Only the content of the source matters, not its modification time.
+    os.utime(source, (destination.stat().st_mtime + 10,) * 2)
+    process_images([(str(source), str(destination), ["grayscale"])], settings)
+    assert process.call_count == 1
+
+    # Changing the operations regenerates the derivative.
+    process_images([(str(source), str(destination), ["flip_vertical"])], settings)
+    assert process.call_count == 2  # noqa: PLR2004
+    process_images([(str(source), str(destination), ["flip_vertical"])], settings)
+    assert process.call_count == 2  # noqa: PLR2004
+
+    # So does changing the settings used to resample or encode it.
+    settings["IMAGE_PROCESS_RESAMPLE"] = "bicubic"
+    process_images([(str(source), str(destination), ["flip_vertical"])], settings)
+    assert process.call_count == 3  # noqa: PLR2004
+    settings["IMAGE_PROCESS_SAVE_OPTIONS"] = {"JPEG": {"quality": 60}}
+    process_images([(str(source), str(destination), ["flip_vertical"])], settings)
+    assert process.call_count == 4  # noqa: PLR2004
+    process_images([(str(source), str(destination), ["flip_vertical"])], settings)
+    assert process.call_count == 4  # noqa: PLR2004
+
+
+def test_source_image_is_decoded_once(mocker, tmp_path):
+    settings = get_settings()
+    image_open = mocker.spy(Image, "open")
+
+    image_path = TEST_IMAGES[0]
+    process_images(
+        [
+            (
+                str(image_path),
+                str(tmp_path.joinpath(transform_id, image_path.name)),
+                transform_params,
+            )
+            for transform_id, transform_params in SINGLE_TRANSFORMS.items()
+        ],
+        settings,
+    )
+
+    image_open.assert_called_once_with(str(image_path))
+
+
+# Custom operations are run by threads, whose calls can be spied.
+@pytest.mark.parametrize("workers", [1, 2])
+def test_destination_directory_is_created_once(mocker, tmp_path, workers):
+    makedirs = mocker.spy(os, "makedirs")
+
+    process_images(
+        [
+            (
+                str(image_path),
+                str(tmp_path.joinpath(image_path.name)),
+                ["grayscale", lambda i: i],
+            )
+            for image_path in TEST_IMAGES
+        ],
+        get_settings(IMAGE_PROCESS_WORKERS=workers),
+    )
+    shutdown_executors(None)
+
+    makedirs.assert_called_once_with(str(tmp_path), exist_ok=True)
+
+
 @pytest.mark.parametrize(
     "orig_src, orig_img, new_src, new_img",
     [
@@ -466,6 +939,220 @@ def test_picture_generation(mocker, orig_tag, new_tag, call_args):
         )
 
 
+def test_picture_generation_leaves_settings_unchanged(mocker):
+    mocker.patch(
+        "pelican.plugins.image_process.image_process.is_img_identifiable",
+        lambda img_filepath: True,
+    )
+    mocker.patch("pelican.plugins.image_process.image_process.process_image")
+
+    transforms = copy.deepcopy(COMPLEX_TRANSFORMS)
+    settings = get_settings(IMAGE_PROCESS=transforms, IMAGE_PROCESS_DIR="derivs")
+    harvest_images_in_fragment(
+        '<div class="figure"><img class="image-process-pict2" src="/tmp/test.jpg"/>'
+        '<img class="source-2 image-process" src="/tmp/test2.jpg"/></div>',
+        settings,
+    )
+
+    assert transforms == COMPLEX_TRANSFORMS
+
+
+@pytest.mark.parametrize(
+    "orig_tag",
+    [
+        '<picture><img class="image-process-pict" src="/images/pelican.jpg"/>'
+        "</picture>",
+        '<div class="figure"><img class="image-process-pict" '
+        'src="/images/pelican.jpg"/></div>',
+    ],
+)
+def test_picture_format_variants(mocker, orig_tag):
+    mocker.patch(
+        "pelican.plugins.image_process.image_process.is_img_identifiable",
+        lambda img_filepath: True,
+    )
+    process = mocker.patch("pelican.plugins.image_process.image_process.process_image")
+
+    transforms = {
+        "pict": {
+            "type": "picture",
+            "sources": [
+                {
+                    "name": "default",
+                    "srcset": [
+                        ("1x", ["scale_in 640 480 True"]),
+                        ("2x", ["scale_in 1280 960 True"]),
+                    ],
+                },
+            ],
+            "default": ("default", "1x"),
+        },
+    }
+    settings = get_settings(
+        IMAGE_PROCESS=transforms,
+        IMAGE_PROCESS_DIR="derivs",
+        IMAGE_PROCESS_FORMATS=["webp"],
+    )
+
+    assert (
+        '<picture><source srcset="/images/derivs/pict/default/1x/pelican.webp 1x, '
+        '/images/derivs/pict/default/2x/pelican.webp 2x" type="image/webp"/>'
+        '<source srcset="/images/derivs/pict/default/1x/pelican.jpg 1x, '
+        '/images/derivs/pict/default/2x/pelican.jpg 2x"/>'
+        '<img class="image-process-pict" '
+        'src="/images/derivs/pict/default/1x/pelican.jpg"/></picture>'
+    ) in harvest_images_in_fragment(orig_tag, settings)
+
+    destinations = [call.args[0][1] for call in process.mock_calls]
+    assert destinations == [
+        os.path.join("output", "images/derivs/pict/default", name)
+        for name in [
+            "1x/pelican.jpg",
+            "1x/pelican.webp",
+            "2x/pelican.jpg",
+            "2x/pelican.webp",
+        ]
+    ]
+
+
+def test_jpeg_variant_of_transparent_image(tmp_path):
+    source = tmp_path.joinpath("transparent.png")
+    image = Image.open(TEST_IMAGES[0]).convert("RGBA")
+    image.putalpha(128)
+    image.save(source)
+    settings = get_settings(IMAGE_PROCESS_FORMATS=["webp", "jpg"])
+
+    for variant, _, _ in get_format_variants(settings, source.name):
+        process_image(
+            (str(source), str(tmp_path.joinpath(variant)), ["scale_in 100 100 False"]),
+            settings,
+        )
+
+    assert Image.open(tmp_path.joinpath("transparent.webp")).mode == "RGBA"
+    assert Image.open(tmp_path.joinpath("transparent.jpg")).mode == "RGB"
+
+
+def test_unsupported_image_format():
+    with pytest.raises(RuntimeError, match='"nope" of IMAGE_PROCESS_FORMATS'):
+        get_settings(IMAGE_PROCESS_FORMATS=["webp", "nope"])
+
+
+def test_process_image_to_webp(tmp_path):
+    destination = tmp_path.joinpath("derivative.webp")
+
+    process_image(
+        (str(TEST_IMAGES[0]), str(destination), ["scale_in 100 100 False"]),
+        get_settings(),
+    )
+
+    assert Image.open(destination).format == "WEBP"
+
+
+def test_save_options(tmp_path):
+    transform = ["scale_in 200 200 False"]
+    default = tmp_path.joinpath("default.jpg")
+    low_quality = tmp_path.joinpath("low-quality.jpg")
+    settings = get_settings(
+        IMAGE_PROCESS_SAVE_OPTIONS={"JPEG": {"quality": 10}, "PNG": {"optimize": True}}
+    )
+
+    process_image((str(TEST_IMAGES[0]), str(default), transform), get_settings())
+    process_image((str(TEST_IMAGES[0]), str(low_quality), transform), settings)
+
+    assert low_quality.stat().st_size < default.stat().st_size
+    assert get_save_options(settings, "a.JPG") == {"progressive": True, "quality": 10}
+    assert get_save_options(settings, "a.webp") == {"progressive": True}
+
+
+@pytest.mark.parametrize("parser", ["html.parser", "lxml"])
+@pytest.mark.parametrize(
+    "orig_fragment, new_fragment",
+    [
+        (
+            '<p>A</p><img class="image-process-thumb" src="/tmp/test.jpg" />',
+            '<p>A</p><img class="image-process-thumb" '
+            'src="/tmp/derivs/thumb/test.jpg"/>',
+        ),
+        (
+            '<script>var a = 1;</script><img class="image-process-thumb" '
+            'src="/tmp/test.jpg" />',
+            '<script>var a = 1;</script><img class="image-process-thumb" '
+            'src="/tmp/derivs/thumb/test.jpg"/>',
+        ),
+        (
+            '<script>var a = "<body>";</script><img class="image-process-thumb" '
+            'src="/tmp/test.jpg" />',
+            '<script>var a = "<body>";</script><img class="image-process-thumb" '
+            'src="/tmp/derivs/thumb/test.jpg"/>',
+        ),
+        (
+            "<!DOCTYPE html><!-- A page --><html><body>"
+            '<img class="image-process-thumb" src="/tmp/test.jpg" /></body></html>',
+            "<!DOCTYPE html>\n<!-- A page --><html><body>"
+            '<img class="image-process-thumb" src="/tmp/derivs/thumb/test.jpg"/>'
+            "</body></html>",
+        ),
+        (
+            '<html lang="en"><head><title>A &amp; B</title></head>'
+            '<body><img class="image-process-thumb" src="/tmp/test.jpg" /></body>'
+            "</html>",
+            '<html lang="en"><head><title>A &amp; B</title></head>'
+            '<body><img class="image-process-thumb" src="/tmp/derivs/thumb/test.jpg"/>'
+            "</body></html>",
+        ),
+    ],
+)
+def test_parsers(mocker, parser, orig_fragment, new_fragment):
+    # Allow non-existing images to be processed:
+    mocker.patch(
+        "pelican.plugins.image_process.image_process.is_img_identifiable",
+        lambda img_filepath: True,
+    )
+    mocker.patch("pelican.plugins.image_process.image_process.process_image")
+
+    settings = get_settings(
+        IMAGE_PROCESS=COMPLEX_TRANSFORMS,
+        IMAGE_PROCESS_DIR="derivs",
+        IMAGE_PROCESS_PARSER=parser,
+    )
+
+    assert harvest_images_in_fragment(orig_fragment, settings) == new_fragment
+
+
+def test_deferred_images_are_processed_once(mocker):
+    mocker.patch(
+        "pelican.plugins.image_process.image_process.is_img_identifiable",
+        lambda img_filepath: True,
+    )
+    process = mocker.patch("pelican.plugins.image_process.image_process.process_image")
+    settings = get_settings(IMAGE_PROCESS_DIR="derivs", IMAGE_PROCESS_DEFER=True)
+
+    tag = '<img class="image-process-crop" src="/tmp/test.jpg"/>'
+    for _ in range(3):
+        harvest_images_in_fragment(tag, settings)
+    process.assert_not_called()
+
+    process_deferred_images(SimpleNamespace(settings=settings))
+    process.assert_called_once()
+
+    process_deferred_images(SimpleNamespace(settings=settings))
+    process.assert_called_once()
+
+
+def test_deferred_images_are_grouped_by_source(mocker):
+    process = mocker.patch("pelican.plugins.image_process.image_process.process_image")
+    settings = get_settings(IMAGE_PROCESS_DEFER=True)
+
+    mocker.patch(
+        "pelican.plugins.image_process.image_process._deferred_images",
+        [("a.jpg", "a1.jpg", []), ("b.jpg", "b1.jpg", []), ("a.jpg", "a2.jpg", [])],
+    )
+    process_deferred_images(SimpleNamespace(settings=settings))
+
+    destinations = [call.args[0][1] for call in process.mock_calls]
+    assert destinations == ["a1.jpg", "a2.jpg", "b1.jpg"]
+
+
 def process_image_mock_exif_tool_started(image, settings):
     assert ExifTool._instance is not None
 
@@ -506,6 +1193,44 @@ def test_exiftool_process_is_started_only_when_necessary(mocker, copy_tags):
     )
 
 
+def test_exiftool_is_not_run_without_tags_to_copy(mocker, tmp_path):
+    image = (str(TEST_IMAGES[0]), str(tmp_path.joinpath("crop.jpg")), ["grayscale"])
+    process_images([image], get_settings())
+
+    mocker.patch("shutil.which", return_value="/usr/bin/exiftool")
+    popen = mocker.patch("subprocess.Popen")
+    process_images([image], get_settings(IMAGE_PROCESS_COPY_EXIF_TAGS=True))
+    popen.assert_not_called()
+
+
+def test_exif_tags_are_copied_in_batches(mocker):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"{ready}\n" * 3)
+    os.close(write_fd)
+    exiftool = ExifTool.__new__(ExifTool)
+    exiftool.encoding, exiftool.pending = "utf-8", []
+    mocker.patch.object(ExifTool, "batch_size", 2)
+    mocker.patch.object(ExifTool, "_instance", exiftool)
+
+    with open(read_fd, "rb") as stdout:
+        exiftool.process = SimpleNamespace(
+            stdin=io.BytesIO(), stdout=stdout, terminate=lambda: None
+        )
+        for name in ["a", "b", "c"]:
+            ExifTool.copy_tags(f"{name}.jpg", f"derivatives/{name}.jpg")
+        commands = exiftool.process.stdin.getvalue()
+        assert commands.count(b"-execute") == 2  # noqa: PLR2004
+        assert commands.startswith(
+            b'-TagsFromFile\na.jpg\n"-all:all>all:all"\n-overwrite_original\n'
+            b"derivatives/a.jpg\n-j\n\n-execute\n"
+        )
+
+        # The last tags are copied when exiftool is stopped.
+        ExifTool.stop_exiftool()
+        commands = exiftool.process.stdin.getvalue()
+        assert commands.count(b"-execute") == 3  # noqa: PLR2004
+
+
 @pytest.mark.parametrize("image_path", EXIF_TEST_IMAGES)
 @pytest.mark.parametrize("copy_tags", [True, False])
 def test_copy_exif_tags(tmp_path, image_path, copy_tags):
@@ -563,6 +1288,41 @@ def test_copy_exif_tags(tmp_path, image_path, copy_tags):
             assert tag not in actual_tags
 
 
+def static_file(source_path, save_as):
+    """Mimic the Static objects of pelican.contents."""
+    return SimpleNamespace(
+        source_path=source_path,
+        settings={"OUTPUT_PATH": "output"},
+        get_url_setting={"save_as": save_as}.get,
+    )
+
+
+def test_compute_paths_static_content():
+    settings = get_settings(
+        static_content={
+            "images/a.jpg": static_file("content/images/a.jpg", "images/a.jpg"),
+            "b.jpg": static_file("content/b.jpg", "b.jpg"),
+            "pictures/b.jpg": static_file("content/pictures/b.jpg", "img/b.jpg"),
+            "empty.jpg": static_file("content/empty.jpg", ""),
+        },
+    )
+
+    path = compute_paths({"src": "/images/a.jpg"}, settings, "thumb")
+    assert path.source == "content/images/a.jpg"
+    assert path.base_path == os.path.join("output", "images", "derivatives", "thumb")
+
+    path = compute_paths({"src": "/img/b.jpg"}, settings, "thumb")
+    assert path.source == "content/b.jpg"
+
+    path = compute_paths({"src": "/other/c.jpg"}, settings, "thumb")
+    assert path.source == os.path.join(settings["PATH"], "other", "c.jpg")
+
+    # The index is updated when static files are added.
+    settings["static_content"]["c.jpg"] = static_file("content/c.jpg", "other/c.jpg")
+    path = compute_paths({"src": "/other/c.jpg"}, settings, "thumb")
+    assert path.source == "content/c.jpg"
+
+
 def test_is_img_identifiable():
     for test_image in TEST_IMAGES:
         assert is_img_identifiable(test_image)
@@ -578,6 +1338,21 @@ def test_is_img_identifiable():
     assert not is_img_identifiable(path.source)
 
 
+def test_is_img_identifiable_once_per_build(mocker, tmp_path):
+    source = tmp_path.joinpath("image.jpg")
+    shutil.copy(TEST_IMAGES[0], source)
+    image_open = mocker.spy(Image, "open")
+
+    assert is_img_identifiable(str(source))
+    assert is_img_identifiable(str(source))
+    assert image_open.call_count == 1
+
+    source.unlink()
+    clear_build_caches(None)
+    assert not is_img_identifiable(str(source))
+    assert image_open.call_count == 2  # noqa: PLR2004
+
+
 def generate_test_images():
     settings = get_settings()
     image_count = 0